@@ -1,10 +1,13 @@
-import subprocess
+import asyncio
 import sqlite3
 from datetime import datetime
-import time
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import os
+import queue
+import re
+import shutil
+import threading
 
 # Base directory
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -15,221 +18,360 @@ LOG_FILE = os.path.join(BASE_DIR, "script.log")
 
 # List of servers to monitor
 SERVERS = ["server1", "server2", "server3"]  # Replace with your server names
+IGNORED_USERS = frozenset({"admin"})  # Users whose sessions are not tracked
 CHECK_INTERVAL = 60  # Check interval in seconds
+MAX_INTERVAL = 300  # Longest check interval in seconds while sessions don't change
+
+# quser resolved once at startup instead of a PATH lookup on every call
+QUSER_BIN = shutil.which("quser") or "quser"
+
+LOG_BUFFER_SIZE = 8192  # Log file write buffer in bytes
+LOG_FLUSH_INTERVAL = 1  # Interval in seconds between log buffer flushes
 
 # Create directory if it doesn't exist
 os.makedirs(BASE_DIR, exist_ok=True)
 
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler that buffers writes and flushes them on a timer."""
+
+    def __init__(self, *args, flush_interval=LOG_FLUSH_INTERVAL, **kwargs):
+        self._stream_size = 0
+        super().__init__(*args, **kwargs)
+        self._flush_stop = threading.Event()
+        self._flush_thread = threading.Thread(
+            target=self._flush_periodically, args=(flush_interval,), daemon=True
+        )
+        self._flush_thread.start()
+
+    def _open(self):
+        """Open the log file with a write buffer and remember its size."""
+        stream = open(self.baseFilename, self.mode, buffering=LOG_BUFFER_SIZE, encoding=self.encoding)
+        self._stream_size = os.path.getsize(self.baseFilename)
+        return stream
+
+    def _flush_periodically(self, interval):
+        """Flush the buffer every `interval` seconds until the handler is closed."""
+        while not self._flush_stop.wait(interval):
+            self.flush()
+
+    def emit(self, record):
+        """Write the record to the buffer without flushing it."""
+        try:
+            msg = self.format(record) + self.terminator
+            size = len(msg.encode(self.encoding))
+            # Text mode writes every "\n" as os.linesep ("\r\n" on Windows)
+            size += msg.count("\n") * (len(os.linesep) - 1)
+            # The size is tracked here because tell() on the stream would flush the buffer
+            if self.maxBytes > 0 and self._stream_size + size >= self.maxBytes:
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(msg)
+            self._stream_size += size
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        """Stop the flush timer and close the file."""
+        self._flush_stop.set()
+        super().close()
+
 # Logging configuration
-handler = RotatingFileHandler(LOG_FILE, maxBytes=500 * 1024, backupCount=1, encoding='utf-8')
+handler = BufferedRotatingFileHandler(LOG_FILE, maxBytes=500 * 1024, backupCount=1, encoding='utf-8')
 handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
 
-logging.basicConfig(
-    level=logging.INFO,
-    handlers=[handler]
+# Records are queued by the application and written to the file by a
+# background thread, so logging never waits on disk I/O
+log_queue = queue.Queue(-1)
+listener = QueueListener(log_queue, handler)
+listener.start()
+
+# Formatting is left to the file handler, so the queue handler is attached
+# directly rather than through basicConfig (which would add its own formatter)
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(QueueHandler(log_queue))
+
+# One line of quser output: USERNAME SESSIONNAME ID STATE IDLE TIME LOGON TIME
+# (the current user's row starts with '>', which is not part of the username)
+QUSER_RE = re.compile(
+    r'^[ \t>]*(\S+)[ \t]+\S+[ \t]+(\d+)[ \t]+(\S+)[ \t]+.*?'
+    r'(\d{1,2}\.\d{1,2}\.\d{4})[ \t]+(\d{1,2}:\d{2})\s*$'
 )
 
+# SQL statements used on every check cycle. Keeping the text constant lets
+# sqlite3 reuse the prepared statements from the connection's statement cache.
+SQL_DELETE_COMPLETED = (
+    "DELETE FROM ActiveSessions WHERE SessionId NOT IN ({placeholders}) "
+    "RETURNING SessionId, Username, LogonTime;"
+)
+SQL_UPSERT_USER = '''
+    INSERT INTO Users (Username, TotalMinutes) VALUES (?, ?)
+    ON CONFLICT(Username) DO UPDATE SET TotalMinutes = TotalMinutes + excluded.TotalMinutes;
+'''
+SQL_INSERT_ACTIVE = "INSERT OR IGNORE INTO ActiveSessions (SessionId, Username, LogonTime) VALUES (?, ?, ?);"
+
+# Persistent database connection and cursor, opened by initialize_database()
+CONN = None
+CURSOR = None
+
+# Session IDs stored in ActiveSessions after the last successful check
+LAST_SESSION_IDS = None
+
+def rollback_transaction():
+    """Roll back the current transaction, if one is open."""
+    if CONN is not None and CONN.in_transaction:
+        CONN.execute("ROLLBACK;")
+
 def initialize_database():
-    """Initialize the database."""
+    """Initialize the database. Returns True if the connection is ready for use."""
+    global CONN, CURSOR
     logging.info("Initializing database...")
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            # Create table for users and their total session time
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS Users (
-                    Username TEXT PRIMARY KEY,
-                    TotalMinutes INTEGER NOT NULL
-                );
-            ''')
-            # Create table for active sessions
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS ActiveSessions (
-                    SessionId TEXT PRIMARY KEY,
-                    Username TEXT NOT NULL,
-                    LogonTime TEXT NOT NULL
-                );
-            ''')
-            conn.commit()
+        # Autocommit mode: transactions are opened explicitly with BEGIN/COMMIT
+        CONN = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+        CONN.execute("PRAGMA journal_mode=WAL;")
+        CONN.execute("PRAGMA synchronous=NORMAL;")
+        CONN.execute("PRAGMA temp_store=MEMORY;")
+
+        CURSOR = CONN.cursor()
+        cursor = CURSOR
+        cursor.execute("BEGIN;")
+        # Create table for users and their total session time
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Users (
+                Username TEXT PRIMARY KEY,
+                TotalMinutes INTEGER NOT NULL
+            );
+        ''')
+        # Create table for active sessions (WITHOUT ROWID: rows are stored in the
+        # SessionId primary key B-tree, so a lookup is a single descent)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ActiveSessions (
+                SessionId TEXT PRIMARY KEY,
+                Username TEXT NOT NULL,
+                LogonTime TEXT NOT NULL
+            ) WITHOUT ROWID;
+        ''')
+        # Drop sessions of ignored users left over from earlier runs, so that
+        # every row in ActiveSessions belongs to a tracked user
+        placeholders = ",".join("?" * len(IGNORED_USERS))
+        cursor.execute(f"DELETE FROM ActiveSessions WHERE Username IN ({placeholders});", tuple(IGNORED_USERS))
+        cursor.execute("COMMIT;")
         logging.info("Database initialized successfully.")
+        return True
     except sqlite3.Error as e:
-        logging.error(f"Error initializing database: {e}")
+        logging.error("Error initializing database: %s", e)
+        # Don't keep a half-initialized connection; the next check retries from scratch
+        if CONN is not None:
+            CONN.close()
+        CONN = None
+        CURSOR = None
+        return False
+
+async def parse_quser_output(stream, server):
+    """Parse sessions from quser output line by line as it arrives."""
+    sessions = []
+    skipped_lines = []
+    header = True
+    async for raw_line in stream:
+        line = raw_line.decode('ibm866')
+        if header:
+            header = False
+            continue
+
+        # System sessions (SessionId is not a number) and unknown formats don't match the pattern
+        match = QUSER_RE.match(line)
+        if not match:
+            if line.strip():
+                logging.debug("Skipping unrecognized quser line from server %s: %s", server, line.strip())
+                skipped_lines.append(line.strip())
+            continue
+        username, session_id, state, logon_date, logon_clock = match.groups()
+
+        # Ignore specific users (e.g., admin)
+        if username in IGNORED_USERS:
+            logging.debug("Ignoring session for user %s (SessionId=%s).", username, session_id)
+            continue
+
+        sessions.append({
+            "Username": username,
+            "SessionId": session_id,
+            "State": state,
+            "LogonTime": f"{logon_date} {logon_clock}"
+        })
+
+    # Nothing could be parsed at all, most likely quser prints an unexpected format (e.g. date locale)
+    if skipped_lines and not sessions:
+        logging.warning(
+            "Could not parse any of %s quser lines from server %s, e.g.: %s",
+            len(skipped_lines), server, skipped_lines[0]
+        )
+    return sessions
 
-def get_active_sessions(server):
+async def get_active_sessions(server):
     """Get active sessions from the server."""
-    logging.info(f"Checking server {server}...")
+    logging.info("Checking server %s...", server)
+    proc = None
     try:
-        result = subprocess.run(
-            ['quser', f'/server:{server}'],
-            capture_output=True,
-            timeout=30,
-            encoding='ibm866'
+        proc = await asyncio.create_subprocess_exec(
+            QUSER_BIN, f'/server:{server}',
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
         )
-        if result.returncode != 0:
-            if "No users exist for *" in result.stderr:
-                logging.info(f"No active users on server {server}.")
-            else:
-                logging.error(f"Error fetching sessions from server {server}. Error: {result.stderr}")
-            return []
 
-        output = result.stdout.strip()
-        if "No users exist for *" in output:
-            logging.info(f"No active users on server {server}.")
+        async def communicate():
+            # Read stderr alongside stdout so neither pipe can fill up and block quser
+            sessions, stderr = await asyncio.gather(parse_quser_output(proc.stdout, server), proc.stderr.read())
+            await proc.wait()
+            return sessions, stderr.decode('ibm866')
+
+        sessions, stderr = await asyncio.wait_for(communicate(), timeout=30)
+        if proc.returncode != 0:
+            if "No users exist for *" in stderr:
+                logging.info("No active users on server %s.", server)
+            else:
+                logging.error("Error fetching sessions from server %s. Error: %s", server, stderr)
             return []
 
-        sessions = []
-        lines = output.splitlines()[1:]  # Skip the header
-        for line in lines:
-            parts = line.split()
-            if len(parts) >= 5:
-                username = parts[0]
-                session_id = parts[2]
-                state = parts[3]
-                logon_time = f"{parts[-2]} {parts[-1]}"
-
-                # Ignore system sessions (SessionId is not a number)
-                if not session_id.isdigit():
-                    logging.warning(f"Ignoring system session: User={username}, SessionId={session_id}.")
-                    continue
-
-                # Ignore specific user (e.g., admin)
-                if username == "admin":
-                    logging.info(f"Ignoring session for user admin (SessionId={session_id}).")
-                    continue
-
-                sessions.append({
-                    "Username": username,
-                    "SessionId": session_id,
-                    "State": state,
-                    "LogonTime": logon_time
-                })
-        logging.info(f"Found {len(sessions)} active sessions on server {server}.")
+        logging.info("Found %s active sessions on server %s.", len(sessions), server)
         return sessions
-    except subprocess.TimeoutExpired:
-        logging.error(f"Timeout while fetching sessions from server {server}.")
+    except asyncio.TimeoutError:
+        logging.error("Timeout while fetching sessions from server %s.", server)
+        # Don't leave a hung quser process behind
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            await proc.wait()
         return []
     except Exception as e:
-        logging.error(f"Error fetching sessions from server {server}: {e}")
+        logging.error("Error fetching sessions from server %s: %s", server, e)
         return []
 
-def update_user_time(username, session_duration):
-    """Update user's total session time in the database."""
-    # Ignore specific user (e.g., admin)
-    if username == "admin":
-        logging.info(f"Ignoring update for user admin.")
-        return
+def parse_logon_time(logon_time_str):
+    """Parse a quser logon time ("dd.mm.yyyy HH:MM") without strptime's regex machinery."""
+    date_part, _, time_part = logon_time_str.partition(" ")
+    day, month, year = date_part.split(".")
+    hour, minute = time_part.split(":")
+    return datetime(int(year), int(month), int(day), int(hour), int(minute))
 
-    logging.info(f"Updating data for user {username} with {session_duration} minutes.")
-    try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO Users (Username, TotalMinutes)
-                VALUES (?, COALESCE((SELECT TotalMinutes FROM Users WHERE Username = ?), 0) + ?);
-            ''', (username, username, session_duration))
-            conn.commit()
-        logging.info(f"Data for user {username} updated successfully.")
-    except sqlite3.Error as e:
-        logging.error(f"Error updating data for user {username}: {e}")
+def check_completed_sessions(active_sessions, current_time):
+    """Check for completed sessions and update the database.
 
-def check_completed_sessions(active_sessions):
-    """Check for completed sessions and update the database."""
-    current_time = datetime.now()
+    `current_time` is the time of the check, used as the end of completed sessions.
+    """
+    global LAST_SESSION_IDS
     completed_sessions = []
 
+    # Nothing started or ended since the last check, so the database is already up to date
+    current_session_ids = {session["SessionId"] for session in active_sessions}
+    if current_session_ids == LAST_SESSION_IDS:
+        logging.info("No session changes since the last check.")
+        return
+
+    # The database could not be opened so far (e.g. locked at startup), try again
+    if CONN is None and not initialize_database():
+        logging.error("Database is not available, skipping this check.")
+        return
+
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-
-            # Get all active sessions from the database
-            cursor.execute("SELECT SessionId, Username, LogonTime FROM ActiveSessions;")
-            db_sessions = cursor.fetchall()
-
-            # Collect all active session IDs from the current check
-            active_session_ids = {session["SessionId"] for session in active_sessions}
-
-            # Check for completed sessions
-            for session_id, username, logon_time_str in db_sessions:
-                if session_id not in active_session_ids:
-                    # Session is completed
-                    logon_time = datetime.strptime(logon_time_str, "%d.%m.%Y %H:%M")
-                    session_duration = round((current_time - logon_time).total_seconds() / 60)
-                    completed_sessions.append((username, session_duration))
-
-                    # Remove completed session from ActiveSessions
-                    cursor.execute("DELETE FROM ActiveSessions WHERE SessionId = ?;", (session_id,))
-                    logging.info(f"Session completed: User={username}, SessionId={session_id}, Duration={session_duration} min.")
-
-            # Update user time in the database for completed sessions
-            if completed_sessions:
-                logging.info(f"Updating data for {len(completed_sessions)} completed sessions.")
-                for username, duration in completed_sessions:
-                    update_user_time(username, duration)
-            else:
-                logging.info("No completed sessions found.")
-
-            # Add new active sessions to the database
-            for session in active_sessions:
-                session_id = session["SessionId"]
-                username = session["Username"]
-                logon_time = session["LogonTime"]
-
-                # Check if the session already exists in the database
-                cursor.execute("SELECT 1 FROM ActiveSessions WHERE SessionId = ?;", (session_id,))
-                if not cursor.fetchone():
-                    # Add new session
-                    cursor.execute("INSERT INTO ActiveSessions (SessionId, Username, LogonTime) VALUES (?, ?, ?);",
-                                  (session_id, username, logon_time))
-                    logging.info(f"New session added to the database: User={username}, SessionId={session_id}, LogonTime={logon_time}.")
-
-            conn.commit()
+        cursor = CURSOR
+        cursor.execute("BEGIN;")
+
+        # Remove completed sessions (those missing from the current check) in one statement
+        active_session_ids = tuple(current_session_ids)
+        placeholders = ",".join("?" * len(active_session_ids))
+        cursor.execute(SQL_DELETE_COMPLETED.format(placeholders=placeholders), active_session_ids)
+
+        # Calculate the duration of each completed session
+        log_sessions = logging.getLogger().isEnabledFor(logging.DEBUG)
+        for session_id, username, logon_time_str in cursor.fetchall():
+            logon_time = parse_logon_time(logon_time_str)
+            session_duration = round((current_time - logon_time).total_seconds() / 60)
+            completed_sessions.append((username, session_duration))
+            if log_sessions:
+                logging.debug("Session completed: User=%s, SessionId=%s, Duration=%s min.", username, session_id, session_duration)
+
+        # Update user time in the database for completed sessions
+        cursor.executemany(SQL_UPSERT_USER, completed_sessions)
+
+        # Add new active sessions to the database (existing ones are skipped by the primary key)
+        cursor.executemany(
+            SQL_INSERT_ACTIVE,
+            [(session["SessionId"], session["Username"], session["LogonTime"]) for session in active_sessions]
+        )
+        added_sessions = cursor.rowcount
+
+        cursor.execute("COMMIT;")
+        LAST_SESSION_IDS = current_session_ids
+        logging.info("Added %s new sessions; removed %s completed sessions.", added_sessions, len(completed_sessions))
     except sqlite3.Error as e:
-        logging.error(f"Error working with the database: {e}")
+        rollback_transaction()
+        logging.error("Error working with the database: %s", e)
 
-def main():
+async def main():
     """Main function."""
     initialize_database()
     last_report_time = datetime.now()  # Time of the last report generation
 
+    async def cycle():
+        """Run a single check cycle and return the IDs of the active sessions."""
+        logging.info("Starting a new check cycle.")
+
+        # Get active sessions from all servers concurrently
+        results = await asyncio.gather(*(get_active_sessions(server) for server in SERVERS))
+        all_active_sessions = [session for sessions in results for session in sessions]
+
+        # Check for completed sessions and update the database
+        check_completed_sessions(all_active_sessions, datetime.now())
+
+        # Example: Generate a report or export data (optional)
+        # You can add your own logic here to export data to files, databases, or external APIs.
+        # For example:
+        # - Export data to a CSV file.
+        # - Send data to an external API.
+        # - Generate a PDF report.
+
+        # Example: Export data to a CSV file
+        # with open("report.csv", "w") as file:
+        #     file.write("Username,TotalMinutes\n")
+        #     with sqlite3.connect(DB_PATH) as conn:
+        #         cursor = conn.cursor()
+        #         cursor.execute("SELECT Username, TotalMinutes FROM Users;")
+        #         for row in cursor.fetchall():
+        #             file.write(f"{row[0]},{row[1]}\n")
+
+        return {session["SessionId"] for session in all_active_sessions}
+
+    interval = CHECK_INTERVAL
+    prev_active_ids = None
+
     try:
         while True:
-            logging.info("Starting a new check cycle.")
-            all_active_sessions = []
-
-            # Get active sessions from all servers
-            for server in SERVERS:
-                sessions = get_active_sessions(server)
-                all_active_sessions.extend(sessions)
-
-            # Check for completed sessions and update the database
-            check_completed_sessions(all_active_sessions)
-
-            # Example: Generate a report or export data (optional)
-            # You can add your own logic here to export data to files, databases, or external APIs.
-            # For example:
-            # - Export data to a CSV file.
-            # - Send data to an external API.
-            # - Generate a PDF report.
-
-            # Example: Export data to a CSV file
-            # with open("report.csv", "w") as file:
-            #     file.write("Username,TotalMinutes\n")
-            #     with sqlite3.connect(DB_PATH) as conn:
-            #         cursor = conn.cursor()
-            #         cursor.execute("SELECT Username, TotalMinutes FROM Users;")
-            #         for row in cursor.fetchall():
-            #             file.write(f"{row[0]},{row[1]}\n")
+            active_ids = await cycle()
+
+            # Back off while the set of sessions stays the same, reset on any change
+            if active_ids == prev_active_ids:
+                interval = min(interval * 2, MAX_INTERVAL)
+            else:
+                interval = CHECK_INTERVAL
+            prev_active_ids = active_ids
 
             # Wait before the next cycle
-            logging.info(f"Waiting {CHECK_INTERVAL} seconds before the next check...")
-            time.sleep(CHECK_INTERVAL)
+            logging.info("Waiting %s seconds before the next check...", interval)
+            await asyncio.sleep(interval)
 
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, asyncio.CancelledError):
         logging.info("Script stopped by the user.")
     except Exception as e:
-        logging.error(f"An error occurred: {e}")
+        logging.error("An error occurred: %s", e)
     finally:
+        if CONN is not None:
+            CONN.close()
         logging.info("Script execution completed.")
+        listener.stop()  # Write out any queued log records
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass  # Already logged by main()
\ No newline at end of file